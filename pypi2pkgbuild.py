@@ -7,15 +7,18 @@ from argparse import (Action, ArgumentParser, ArgumentDefaultsHelpFormatter,
                       RawDescriptionHelpFormatter)
 import ast
 from collections import namedtuple
+from concurrent.futures import Future, ThreadPoolExecutor
 from contextlib import suppress
-from functools import lru_cache
+from email.parser import BytesParser
+from functools import cached_property, lru_cache, partial
 import hashlib
+import http.client
 import importlib.metadata
-from io import StringIO
+from io import BytesIO
 import json
 import logging
 import os
-from pathlib import Path
+from pathlib import Path, PurePosixPath
 import re
 import shlex
 import shutil
@@ -23,9 +26,14 @@ import site
 import subprocess
 from subprocess import CalledProcessError, PIPE, DEVNULL
 import sys
+import tarfile
 from tempfile import NamedTemporaryFile, TemporaryDirectory
 import textwrap
+import threading
+import time
+from types import MappingProxyType
 import urllib.request
+import zipfile
 
 try:
     import setuptools_scm
@@ -40,12 +48,15 @@ except (ImportError, LookupError):
 
 
 LOGGER = logging.getLogger(Path(__file__).stem)
+CACHE_DIR = Path(
+    os.environ.get("XDG_CACHE_HOME") or "~/.cache", "pypi2pkgbuild"
+).expanduser()
 
 PKGTYPES = ["anywheel", "sdist", "manylinuxwheel"]
-PY_TAGS = ["py{0.major}".format(sys.version_info),
-           "cp{0.major}".format(sys.version_info),
-           "py{0.major}{0.minor}".format(sys.version_info),
-           "cp{0.major}{0.minor}".format(sys.version_info)]
+PY_TAGS = frozenset(["py{0.major}".format(sys.version_info),
+                     "cp{0.major}".format(sys.version_info),
+                     "py{0.major}{0.minor}".format(sys.version_info),
+                     "cp{0.major}{0.minor}".format(sys.version_info)])
 THIS_ARCH = ["i686", "x86_64"][sys.maxsize > 2 ** 32]
 LICENSE_NAMES = ["LICENSE", "LICENSE.txt", "license.txt",
                  "COPYING", "COPYING.md", "COPYING.rst", "COPYING.txt",
@@ -114,9 +125,10 @@ TROVE_SPECIAL_LICENSES = {  # Standard licenses with specific line.
     "Python License (CNRI Python License)":
         "Python",
 }
+TROVE_LICENSES = {**TROVE_COMMON_LICENSES, **TROVE_SPECIAL_LICENSES}
 
 PKGBUILD_HEADER = """\
-# Maintainer: {config[PACKAGER]}
+# Maintainer: {packager}
 
 export PIP_CONFIG_FILE=/dev/null
 export PIP_DISABLE_PIP_VERSION_CHECK=true
@@ -165,9 +177,16 @@ md5sums+=({md5s})
 PKGBUILD_CONTENTS = """\
 
 _first_source() {
-    echo " ${source_i686[@]} ${source_x86_64[@]} ${source[@]}" |
-        tr ' ' '\\n' | grep -Pv '^(PKGBUILD_EXTRAS)?$' | head -1
+    if [[ -z "$_FIRST_SOURCE" ]]; then
+        _FIRST_SOURCE="$(
+            echo " ${source_i686[@]} ${source_x86_64[@]} ${source[@]}" |
+                tr ' ' '\\n' | grep -Pv '^(PKGBUILD_EXTRAS)?$' | head -1)"
+    fi
+    echo "$_FIRST_SOURCE"
 }
+# Populate the cache in the main shell, as later calls are mostly made from
+# command substitutions (i.e., subshells) which cannot update it.
+_first_source >/dev/null
 
 _vcs="$(grep -Po '^[a-z]+(?=\\+)' <<< "$(_first_source)")"
 if [[ "$_vcs" ]]; then
@@ -209,10 +228,14 @@ _build() {
     cd "$srcdir"
     # See Arch Wiki/PKGBUILD/license.
     # Get the first filename that matches.
-    local test_name
+    local dist_name test_name
+    dist_name="$(_dist_name)"
     if [[ ${license[0]} =~ ^(BSD|MIT|ZLIB|Python)$ ]]; then
+        # Use the builtin test rather than attempting a cp for each candidate,
+        # so that at most one process gets spawned.
         for test_name in """ + " ".join(LICENSE_NAMES) + """; do
-            if cp "$srcdir/$(_dist_name)/$test_name" "$srcdir/LICENSE" 2>/dev/null; then
+            if [[ -f "$srcdir/$dist_name/$test_name" ]]; then
+                cp "$srcdir/$dist_name/$test_name" "$srcdir/LICENSE"
                 break
             fi
         done
@@ -230,7 +253,7 @@ _build() {
     # numpy/scipy.
     XDG_CACHE_HOME="${XDG_CACHE_HOME:-"$HOME/.cache"}" HOME=_tmpenv \\
         _tmpenv/bin/pip wheel -v --no-deps --wheel-dir="$srcdir" \\
-        "./$(_dist_name)" || true
+        "./$dist_name" || true
 }
 
 build() { _build; }
@@ -286,11 +309,19 @@ package() {
 }
 """
 
+# Used to overlap network- and subprocess-bound lookups (PyPI queries, pkgfile
+# calls, etc.); do not submit tasks that themselves wait on this executor.
+_EXECUTOR = ThreadPoolExecutor(max_workers=16)
+
 
 def _run_shell(args, **kwargs):
     """
     Logging wrapper for `subprocess.run`, with useful defaults.
 
+    *args* is run through the shell if it is a str; prefer passing a list
+    whenever no shell features (pipes, redirections) are needed, as that
+    avoids spawning an intermediate ``/bin/sh``.
+
     Log at ``DEBUG`` level except if the *verbose* kwarg is set, in which case
     log at ``INFO`` level.
     """
@@ -339,15 +370,27 @@ def _run_shell_stdout(args, **kwargs):
 def _get_readonly_clean_venv():  # "readonly" is an intent, but not enforced.
     venv_dir = TemporaryDirectory()
     _run_shell(["python", "-mvenv", venv_dir.name])
-    _run_shell([  # needed for version parsing
-        f"{venv_dir.name}/bin/pip", "install", "packaging"],
+    _run_shell([  # packaging is needed for version parsing, and pip>=22.3
+        # for `pip --python` (see _build_metadata).
+        f"{venv_dir.name}/bin/pip", "install", "--upgrade",
+        "pip", "packaging"],
         stdout=DEVNULL)
     return venv_dir  # Don't let venv_dir get GC'd.
 
 
+_CLEAN_VENV_LOCK = threading.Lock()
+# Dependencies may be packaged concurrently, but pacman holds a global lock.
+# makepkg runs also take it, as they may call pacman too (e.g. with -m -s).
+_PACMAN_LOCK = threading.Lock()
+# Bounds the number of concurrent metadata builds (each one a venv and a pip
+# install, possibly compiling an sdist).
+_BUILD_METADATA_SEMAPHORE = threading.Semaphore(os.cpu_count() or 1)
+
+
 def _run_python(args, **kwargs):
     """Run python from a temporary venv."""
-    venv_dir = _get_readonly_clean_venv().name
+    with _CLEAN_VENV_LOCK:  # Don't create the venv twice from two threads.
+        venv_dir = _get_readonly_clean_venv().name
     return _run_shell(  # args must be a list; str is not supported.
         [f"{venv_dir}/bin/python"] + args, **kwargs)
 
@@ -368,19 +411,29 @@ def get_makepkg_conf():
         """)
         Path(tmpdir, "PKGBUILD").write_text(mini_pkgbuild)
         try:
-            _run_shell("makepkg", cwd=tmpdir, stdout=PIPE, stderr=PIPE)
+            _run_shell(["makepkg"], cwd=tmpdir, stdout=PIPE, stderr=PIPE)
         except CalledProcessError as e:
             sys.stderr.write(e.stderr)
             raise
         out = Path(tmpdir, "src/log.txt").read_text()
-    return dict(pair.split(" ", 1) for pair in out.split("\0"))
+    # Read-only, as the result is shared by all callers via the cache.
+    return MappingProxyType(
+        dict(pair.split(" ", 1) for pair in out.split("\0")))
+
+
+def get_packager():
+    # makepkg lets $PACKAGER override makepkg.conf; checking it first avoids
+    # running the (slow) makepkg probe when the flags are not needed either.
+    return os.environ.get("PACKAGER") or get_makepkg_conf()["PACKAGER"]
+
+
+_ARCH_VERSION_RE = re.compile(r"(?:(.*):)?(.*)-(.*)")
 
 
 class ArchVersion(namedtuple("_ArchVersion", "epoch pkgver pkgrel")):
     @classmethod
     def parse(cls, s):
-        epoch, pkgver, pkgrel = (
-            re.fullmatch(r"(?:(.*):)?(.*)-(.*)", s).groups())
+        epoch, pkgver, pkgrel = _ARCH_VERSION_RE.fullmatch(s).groups()
         return cls(epoch or "", pkgver, pkgrel)
 
     def __str__(self):
@@ -388,20 +441,31 @@ class ArchVersion(namedtuple("_ArchVersion", "epoch pkgver pkgrel")):
                 else f"{self.pkgver}-{self.pkgrel}")
 
 
+_WHEEL_RE = re.compile(
+    r"(?P<name>[^-]+)-(?P<version>[^-]+)(?:-(?P<build>[^-]+))?"
+    r"-(?P<pythons>[^-]+)-(?P<abi>[^-]+)-(?P<platform>[^-]+)\.whl")
+_WHEEL_PLATFORM_RE = re.compile(
+    "(any)"
+    # https://peps.python.org/pep-0600/#package-indexes
+    "|manylinux1_(x86_64|i686)"
+    "|manylinux2010_(x86_64|i686)"
+    "|manylinux2014_(x86_64|i686|aarch64|armv7l|ppc64|ppc64le|s390x)"
+    "|manylinux_[0-9]+_[0-9]+_(.*)")
+
+
 class WheelInfo(
         namedtuple("_WheelInfo", "name version build pythons abi platform")):
     @classmethod
+    @lru_cache()  # Results are shared, hence pythons being a frozenset.
     def parse(cls, url):
-        parts = Path(urllib.parse.urlparse(url).path).stem.split("-")
-        if len(parts) == 5:
-            name, version, pythons, abi, platform = parts
-            build = ""
-        elif len(parts) == 6:
-            name, version, build, pythons, abi, platform = parts
-        else:
+        match = _WHEEL_RE.fullmatch(
+            urllib.parse.urlparse(url).path.rpartition("/")[2])
+        if not match:
             raise ValueError(f"Invalid wheel url: {url}")
+        name, version, build, pythons, abi, platform = match.groups()
         return cls(
-            name, version, build, set(pythons.split(".")), abi, platform)
+            name, version, build or "", frozenset(pythons.split(".")), abi,
+            platform)
 
     def get_arch_platforms(self):
         # any -> any
@@ -409,15 +473,9 @@ class WheelInfo(
         # No other wheel tags (e.g. windows/macos) reach this point because
         # they are first filtered away by _filter_and_sort_urls.
         platforms = []
-        regex = (
-            "(any)"
-            # https://peps.python.org/pep-0600/#package-indexes
-            "|manylinux1_(x86_64|i686)"
-            "|manylinux2010_(x86_64|i686)"
-            "|manylinux2014_(x86_64|i686|aarch64|armv7l|ppc64|ppc64le|s390x)"
-            "|manylinux_[0-9]+_[0-9]+_(.*)")
         for part in self.platform.split("."):
-            platform, = filter(None, re.fullmatch(regex, part).groups())
+            platform, = filter(
+                None, _WHEEL_PLATFORM_RE.fullmatch(part).groups())
             platforms.append(platform)
         return platforms
 
@@ -440,8 +498,11 @@ class PackagingError(Exception):
     pass
 
 
+_VCS_RE = re.compile(r"\A[a-z]+(?=\+)")
+
+
 def _get_vcs(name):
-    match = re.match(r"\A[a-z]+(?=\+)", name)
+    match = _VCS_RE.match(name)
     return match.group(0) if match else None
 
 
@@ -462,6 +523,167 @@ def _vcs_get_url_rev(url):
     return url, rev
 
 
+_HTTP_CONNECTIONS = threading.local()
+_HTTP_TIMEOUT = 60  # seconds; don't hang forever on a stalled connection.
+# Transient server-side failures are retried after 0.3s, 0.6s, 1.2s.
+_HTTP_RETRY_STATUSES = {429, 500, 502, 503, 504}
+_HTTP_RETRY_DELAYS = [.3, .6, 1.2]
+_HTTP_MAX_REDIRECTIONS = 10  # As urllib.request.HTTPRedirectHandler.
+
+
+def _urlopen(url, headers=None, *, _redirections=0):
+    """
+    Like `urllib.request.urlopen`, but reuse HTTP(S) connections.
+
+    Connections are kept alive per thread and per host, which avoids paying
+    for a new TCP and TLS handshake on each of the many requests made to PyPI
+    and GitHub.  Other schemes (e.g. ``file://``), and proxied requests (per
+    ``$http_proxy``, ``$https_proxy`` and ``$no_proxy``), are forwarded to
+    `urllib.request.urlopen`.  As with the latter, HTTP errors (including too
+    many redirections) are raised as `urllib.error.HTTPError`.
+
+    The response must be fully read before the next call.
+    """
+    parsed = urllib.parse.urlsplit(url)
+    if (parsed.scheme not in ["http", "https"]
+            or (parsed.scheme in urllib.request.getproxies()
+                and not urllib.request.proxy_bypass(parsed.hostname or ""))):
+        return urllib.request.urlopen(
+            urllib.request.Request(url, headers=headers or {}),
+            timeout=_HTTP_TIMEOUT)
+    conns = vars(_HTTP_CONNECTIONS)
+    key = parsed.scheme, parsed.netloc
+    path = urllib.parse.urlunsplit(
+        ("", "", parsed.path or "/", parsed.query, ""))
+    headers = {"User-Agent": f"pypi2pkgbuild/{__version__}", **(headers or {})}
+    for delay in [*_HTTP_RETRY_DELAYS, None]:
+        for retry in [False, True]:
+            if key not in conns:
+                conns[key] = (
+                    http.client.HTTPSConnection if parsed.scheme == "https"
+                    else http.client.HTTPConnection)(
+                        parsed.netloc, timeout=_HTTP_TIMEOUT)
+            try:
+                conns[key].request("GET", path, headers=headers)
+                response = conns[key].getresponse()
+            except (ConnectionError, http.client.HTTPException):
+                # The server may have closed an idle connection; retry once on
+                # a fresh one.
+                conns.pop(key).close()
+                if retry:
+                    raise
+            else:
+                break
+        if response.status not in _HTTP_RETRY_STATUSES or delay is None:
+            break
+        response.read()
+        LOGGER.debug("Got HTTP %s for %s; retrying in %ss.",
+                     response.status, url, delay)
+        time.sleep(delay)
+    if response.status in [301, 302, 303, 307, 308]:
+        if _redirections >= _HTTP_MAX_REDIRECTIONS:
+            raise urllib.error.HTTPError(
+                url, response.status,
+                f"Too many redirections; the last one was {response.reason}",
+                response.headers, BytesIO(response.read()))
+        response.read()
+        return _urlopen(
+            urllib.parse.urljoin(url, response.headers["Location"]), headers,
+            _redirections=_redirections + 1)
+    if response.status >= 400:
+        raise urllib.error.HTTPError(
+            url, response.status, response.reason, response.headers,
+            BytesIO(response.read()))
+    return response
+
+
+# Set by --no-cache.
+_CACHE_ALWAYS_REVALIDATE = False
+# Other errors (e.g. 403 or 429 due to rate limits, 5xx) are transient, and
+# thus not written to the cache.
+_HTTP_CACHEABLE_ERRORS = {404, 410}
+
+
+def _write_cache_file(path, data):
+    # Write atomically, as concurrent runs (or threads) may share the cache.
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with NamedTemporaryFile(dir=path.parent, prefix=".tmp",
+                            delete=False) as file:
+        file.write(data)
+    os.replace(file.name, path)
+
+
+def _get_url_cached(url, *, max_age, error_ok=False):
+    """
+    Return the contents of *url*, going through an on-disk HTTP cache.
+
+    Responses (including 404 and 410 errors, which are re-raised as
+    `urllib.error.HTTPError`) younger than *max_age* seconds are reused as is;
+    older ones are revalidated with a conditional request if the server sent
+    an ``ETag`` or ``Last-Modified`` header, or reused (with a warning) if the
+    server cannot be reached or fails transiently.  If
+    `_CACHE_ALWAYS_REVALIDATE` is set, even young responses are revalidated.
+
+    If *error_ok* is set, return None instead of raising on HTTP errors.
+    """
+    key = hashlib.blake2b(url.encode("utf-8"), digest_size=16).hexdigest()
+    body_path = CACHE_DIR / key
+    meta_path = CACHE_DIR / f"{key}.json"
+    try:
+        meta = json.loads(meta_path.read_text())
+        body = body_path.read_bytes()
+        age = time.time() - meta_path.stat().st_mtime
+    except (OSError, ValueError):
+        meta = body = None
+    if meta is None or age >= max_age or _CACHE_ALWAYS_REVALIDATE:
+        headers = {}
+        if meta and meta["etag"]:
+            headers["If-None-Match"] = meta["etag"]
+        if meta and meta["last_modified"]:
+            headers["If-Modified-Since"] = meta["last_modified"]
+        try:
+            try:
+                response = _urlopen(url, headers)
+                status = response.status
+            except urllib.error.HTTPError as exc:
+                response = exc
+                status = exc.code
+            response_body = response.read()
+        except (OSError, http.client.HTTPException) as exc:
+            if meta is None:
+                raise
+            # e.g. offline: a stale answer beats no answer.
+            LOGGER.warning("Could not revalidate %s (%s); using cached copy.",
+                           url, exc)
+        else:
+            if status == 304:
+                meta_path.touch()  # Restart the max_age timer.
+            elif status < 400 or status in _HTTP_CACHEABLE_ERRORS:
+                meta = {"status": status,
+                        "reason": response.reason,
+                        "etag": response.headers.get("ETag"),
+                        "last_modified": response.headers.get("Last-Modified")}
+                body = response_body
+                # The body goes first as the metadata marks it valid.
+                _write_cache_file(body_path, body)
+                _write_cache_file(meta_path, json.dumps(meta).encode())
+            elif meta is not None:
+                # e.g. rate limit or server error: likewise, don't let a
+                # transient failure override a previous answer.
+                LOGGER.warning(
+                    "Could not revalidate %s (HTTP %s); using cached copy.",
+                    url, status)
+            else:  # Report the error, but don't remember it.
+                meta = {"status": status, "reason": response.reason}
+                body = response_body
+    if meta["status"] >= 400:
+        if error_ok:
+            return None
+        raise urllib.error.HTTPError(
+            url, meta["status"], meta["reason"], None, BytesIO(body))
+    return body
+
+
 @lru_cache()
 def _get_url_impl(url):
     cache_dir = TemporaryDirectory()
@@ -481,8 +703,9 @@ def _get_url_impl(url):
             raise PackagingError(f"Failed to download {parsed.netloc}, "
                                  "possibly due to a buggy setup.py")
     else:
-        Path(cache_dir.name, Path(parsed.path).name).write_bytes(
-            urllib.request.urlopen(url).read())
+        # Stream to disk, rather than holding the whole archive in memory.
+        with Path(cache_dir.name, Path(parsed.path).name).open("wb") as file:
+            shutil.copyfileobj(_urlopen(url), file, 1 << 20)
     packed_path, = (path for path in Path(cache_dir.name).iterdir())
     return cache_dir, packed_path  # Don't let cache_dir get GC'd.
 
@@ -508,20 +731,111 @@ def _get_url_unpacked_path_or_null(url):
     return unpacked_path
 
 
+SourceTreeScan = namedtuple("SourceTreeScan", "suffixes license")
+
+
+def _iter_archive(path):
+    """
+    Yield ``(relpath, read)`` pairs for the regular files in the archive at
+    *path*, where *relpath* is relative to the archive's top-level directory
+    and ``read()`` returns the file contents, without extracting the archive.
+    """
+    def _relpath(name):
+        return PurePosixPath(*PurePosixPath(name).parts[1:])
+
+    if zipfile.is_zipfile(path):
+        with zipfile.ZipFile(path) as zf:
+            for info in zf.infolist():
+                if not info.is_dir():
+                    yield _relpath(info.filename), partial(zf.read, info)
+    else:
+        # Streaming mode: members must be read while they are iterated over.
+        with tarfile.open(path, "r|*") as tf:
+            for member in tf:
+                if member.isfile():
+                    yield (_relpath(member.name),
+                           lambda member=member: tf.extractfile(member).read())
+
+
+@lru_cache()
+def _scan_url_tree(url):
+    """
+    Scan the source tree at *url* in a single pass.
+
+    Return the makedepends-relevant suffixes (``.i``, ``.pyx``) found anywhere
+    in the tree, and the contents of the top-level license file (or None).
+    Archives are scanned without being unpacked.
+    """
+    parsed = urllib.parse.urlparse(url)
+    if parsed.scheme == "file" and parsed.path.endswith(".whl"):
+        return SourceTreeScan(frozenset(), None)
+    try:
+        cache_dir, packed_path = _get_url_impl(url)
+    except CalledProcessError:
+        return SourceTreeScan(frozenset(), None)
+    suffixes = set()
+    licenses = {}
+    if packed_path.is_dir():  # VCS checkout.
+        for dirpath, dirnames, filenames in os.walk(packed_path):
+            if dirpath == str(packed_path):
+                licenses = {name: Path(dirpath, name).read_bytes()
+                            for name in LICENSE_NAMES if name in filenames}
+            suffixes.update(
+                {os.path.splitext(name)[1] for name in filenames}
+                & {".i", ".pyx"})
+            if len(suffixes) == 2:  # Nothing more to find.
+                break
+            # Skip the (possibly large) VCS metadata directories.
+            dirnames[:] = [name for name in dirnames
+                           if name not in {".bzr", ".git", ".hg", ".svn"}]
+    else:
+        for relpath, read in _iter_archive(packed_path):
+            if relpath.suffix in {".i", ".pyx"}:
+                suffixes.add(relpath.suffix)
+            elif str(relpath) in LICENSE_NAMES:
+                licenses[str(relpath)] = read()
+    return SourceTreeScan(
+        frozenset(suffixes),
+        next((licenses[name] for name in LICENSE_NAMES if name in licenses),
+             None))
+
+
 @lru_cache()
 def _guess_url_makedepends(url, guess_makedepends):
     makedepends = []
-    if ("swig" in guess_makedepends
-            and list(_get_url_unpacked_path_or_null(url).glob("**/*.i"))):
+    if not {"swig", "cython"} & {*guess_makedepends}:
+        return DependsTuple(makedepends)  # Don't even fetch the sources.
+    suffixes = _scan_url_tree(url).suffixes
+    if "swig" in guess_makedepends and ".i" in suffixes:
         makedepends.append(NonPyPackageRef("swig"))
-    if ("cython" in guess_makedepends
-            and list(_get_url_unpacked_path_or_null(url).glob("**/*.pyx"))):
+    if "cython" in guess_makedepends and ".pyx" in suffixes:
         makedepends.append(PackageRef("Cython"))
     return DependsTuple(makedepends)
 
 
 @lru_cache()
-def _get_metadata(name, setup_requires):
+def _get_metadata(name, setup_requires, artifact=None):
+    # If given, *artifact* is the file name of the PyPI artifact that *name*
+    # resolves to.  As PyPI files are immutable, the metadata is then cached on
+    # disk across runs (for a given Python).  Keying on the requirement instead
+    # would be incorrect, as it may resolve differently once a post-release is
+    # uploaded.
+    if artifact is None:
+        return _build_metadata(name, setup_requires)
+    key = hashlib.blake2b(
+        json.dumps([artifact, setup_requires, sys.implementation.cache_tag,
+                    THIS_ARCH]).encode("utf-8"),
+        digest_size=16).hexdigest()
+    path = CACHE_DIR / "metadata" / f"{key}.json"
+    if not _CACHE_ALWAYS_REVALIDATE:
+        with suppress(OSError, ValueError):
+            return json.loads(path.read_text())
+    metadata = _build_metadata(name, setup_requires)
+    _write_cache_file(path, json.dumps(metadata).encode("utf-8"))
+    return metadata
+
+
+def _build_metadata(name, setup_requires):
     # Dependency resolution is done by installing the package in a venv and
     # calling `pip show`; otherwise it would be necessary to parse environment
     # markers (from "requires_dist").  The package name may get denormalized
@@ -532,24 +846,45 @@ def _get_metadata(name, setup_requires):
     #
     # To handle sdists that depend on numpy, we just see whether installing in
     # presence of numpy makes things better...
-    with TemporaryDirectory() as venv_dir, \
+    with _CLEAN_VENV_LOCK:
+        clean_venv_dir = _get_readonly_clean_venv().name
+    with _BUILD_METADATA_SEMAPHORE, \
+         TemporaryDirectory() as venv_dir, \
          NamedTemporaryFile("r") as more_requires_log, \
          NamedTemporaryFile("r") as log:
         script = textwrap.dedent(r"""
             set -e
-            python -mvenv {venv_dir}
+            python -mvenv --without-pip {venv_dir}
             # Leave the source directory, which may contain wheels/sdists/etc.
             cd {venv_dir}
             . '{venv_dir}/bin/activate'
+            # Installing pip dominates venv creation, so drive this venv with
+            # the pip of the shared clean venv instead (needs pip>=22.3).
+            pip() {{
+                '{clean_venv_dir}/bin/python' -m pip \
+                    --python '{venv_dir}/bin/python' "$@"
+            }}
+            # Before Python 3.12, venvs came with setuptools, which legacy
+            # sdists may rely on.
+            if python -c 'import sys; sys.exit(sys.version_info >= (3, 12))'
+            then
+                pip install setuptools >/dev/null
+            fi
             if [[ -n '{setup_requires}' ]]; then
                 pip install --upgrade {setup_requires} >/dev/null
             fi
+            list_cmd() {{
+                # Much faster than `pip list`, which imports all of pip.
+                python -c 'import importlib.metadata as m; print(*{{
+                    d.metadata["Name"] for d in m.distributions()}},
+                    sep="\n")' | sort
+            }}
             install_cmd() {{
-                pip list --format=freeze | cut -d= -f1 | sort >'{venv_dir}/a'
+                list_cmd >'{venv_dir}/a'
                 if ! pip install --no-deps '{req}'; then
                     return 1
                 fi
-                pip list --format=freeze | cut -d= -f1 | sort >'{venv_dir}/b'
+                list_cmd >'{venv_dir}/b'
                 # installed name, or real name if it doesn't appear
                 # (setuptools, pip, Cython, numpy).
                 install_name="$(comm -13 '{venv_dir}/a' '{venv_dir}/b')"
@@ -580,14 +915,15 @@ def _get_metadata(name, setup_requires):
             fi
         """).format(
             venv_dir=venv_dir,
+            clean_venv_dir=clean_venv_dir,
             setup_requires=" ".join(setup_requires),
             req=(_get_url_unpacked_path_or_null(name)
                  if _get_vcs(name) else name),
             more_requires_log=more_requires_log,
             log=log)
         try:
-            out = _run_shell_stdout(
-                script, env={
+            out = _run_shell_stdout(  # The script uses bashisms.
+                ["bash", "-c", script], env={
                     # Matters, as a built wheel would get cached.
                     "CFLAGS": get_makepkg_conf()["CFLAGS"],
                     # Not actually used, per pypa/setuptools#1192.  Still
@@ -607,6 +943,76 @@ def _get_metadata(name, setup_requires):
     return {key.replace("-", "_"): value for key, value in metadata.items()}
 
 
+@lru_cache()
+def _get_wheel_requires(path):
+    """
+    Return the names of the requirements of the wheel at *path*, excluding
+    those whose environment markers are not satisfied, or None if its metadata
+    cannot be read.
+    """
+    # Unlike sdists, wheels have static metadata, which can be read directly
+    # instead of installing the package in a venv (see _get_metadata).
+    with zipfile.ZipFile(path) as wheel:
+        metadata_names = [
+            name for name in wheel.namelist()
+            if re.fullmatch(r"[^/]*\.dist-info/METADATA", name)]
+        if len(metadata_names) != 1:  # Malformed wheel.
+            return None
+        metadata = BytesParser().parsebytes(wheel.read(*metadata_names))
+    try:
+        return _evaluate_requirements(
+            tuple(metadata.get_all("Requires-Dist") or []))
+    except CalledProcessError:  # e.g. invalid requirement or marker.
+        return None
+
+
+@lru_cache()
+def _get_sdist_requires(path):
+    """
+    Return the names of the requirements of the sdist at *path*, excluding
+    those whose environment markers are not satisfied, or None if its metadata
+    does not declare them statically.
+    """
+    # Per PEP 643, the PKG-INFO of sdists (from Metadata-Version 2.2 onwards)
+    # is authoritative for all fields not listed as Dynamic.
+    for relpath, read in _iter_archive(path):
+        if str(relpath) == "PKG-INFO":
+            metadata = BytesParser().parsebytes(read())
+            break
+    else:
+        return None
+    try:
+        version = tuple(map(int, metadata["Metadata-Version"].split(".")))
+    except (AttributeError, ValueError):
+        return None
+    dynamic = {field.lower() for field in metadata.get_all("Dynamic") or []}
+    if version < (2, 2) or "requires-dist" in dynamic:
+        return None
+    try:
+        return _evaluate_requirements(
+            tuple(metadata.get_all("Requires-Dist") or []))
+    except CalledProcessError:  # e.g. invalid requirement or marker.
+        return None
+
+
+@lru_cache()
+def _evaluate_requirements(requirements):
+    """
+    Return the names of the PEP 508 *requirements* (a tuple of strings) whose
+    environment markers are satisfied, ignoring extras.
+    """
+    if not requirements:
+        return []
+    src = ("from sys import argv; "
+           "from packaging.requirements import Requirement; "
+           "reqs = map(Requirement, argv[1:]); "
+           "print([req.name for req in reqs "
+           "       if not req.marker or req.marker.evaluate({'extra': ''})])")
+    names = ast.literal_eval(
+        _run_python(["-c", src, *requirements], stdout=PIPE).stdout)
+    return [*dict.fromkeys(names)]  # Unique, in order.
+
+
 @lru_cache()
 def _get_info(name, *,
               pre=False,
@@ -660,12 +1066,14 @@ def _get_info(name, *,
 
     def _get_info_pypi():
         try:
-            r = urllib.request.urlopen(
+            request = json.loads(_get_url_cached(
                 f"https://pypi.org/pypi/{name}/{_version}/json"
-                if _version else f"https://pypi.org/pypi/{name}/json")
+                if _version else f"https://pypi.org/pypi/{name}/json",
+                # The list of releases can change at any time, but the info
+                # for a given release essentially doesn't.
+                max_age=24 * 60 * 60 if _version else 60))
         except urllib.error.HTTPError:
             return
-        request = json.loads(r.read())
         if not _version:
             if not request["releases"]:
                 raise PackagingError(f"No suitable release found for {name}.")
@@ -705,51 +1113,133 @@ def _get_info(name, *,
 #     `.{dist,egg}-info`.
 
 
-def _find_installed_name_version(pep503_name, *, ignore_vendored=False):
-    parts = (
-        _run_shell_stdout(
-            "find . -maxdepth 1 -iname '%s[.-]*-info' "
-            "-exec pacman -Qo '{}' \\; | rev | cut -d' ' -f1,2 | rev"
-            % (to_wheel_name(pep503_name)
-               # https://github.com/pypa/wheel/issues/440
-               .replace("-", "[-.]").replace("_", "[_.]")),
-            cwd=site.getsitepackages()[0]).split()
-        or _run_shell_stdout(
-            f"pacman -Q python-{pep503_name} 2>/dev/null",
-            check=False).split())
-    if parts:
-        pkgname, version = parts  # This will raise if there is an ambiguity.
+# {pep503_name: {"pkgname version": None, ...}}; must be cleared whenever
+# packages get installed.
+_INSTALLED_OWNERS = {}
+
+
+def _find_installed_owners(pep503_names):
+    """
+    Map each of *pep503_names* to the "pkgname version" strings of the
+    installed packages providing it, looking up all uncached names with a
+    single pacman call (instead of one per name).
+    """
+    owners = {name: _INSTALLED_OWNERS.get(name)
+              for name in dict.fromkeys(pep503_names)}
+    pep503_names = [name for name in owners if owners[name] is None]
+    if not pep503_names:
+        return owners
+    site_packages = site.getsitepackages()[0]
+    entries = os.listdir(site_packages)
+    # {info_path: {pep503_name: None, ...}}; a path can match multiple names
+    # (e.g. `foo.bar-1.0-py3.11.egg-info` matches both `foo` and `foo-bar`).
+    infos = {}
+    for pep503_name in pep503_names:
+        info_re = re.compile(
+            # https://github.com/pypa/wheel/issues/440
+            to_wheel_name(pep503_name).replace("_", "[_.]") + "[.-].*-info",
+            re.IGNORECASE)
+        for entry in entries:
+            if info_re.fullmatch(entry):
+                infos.setdefault(
+                    str(Path(site_packages, entry)), {})[pep503_name] = None
+    found = {}  # Same format as _INSTALLED_OWNERS.
+    if infos:
+        for line in _run_shell_stdout(
+                ["pacman", "-Qo", *infos], check=False).splitlines():
+            path, _, owner = line.rpartition(" is owned by ")
+            for pep503_name in infos.get(path.rstrip("/"), {}):
+                found.setdefault(pep503_name, {})[owner] = None
+    missing = {f"python-{pep503_name}": pep503_name
+               for pep503_name in pep503_names if pep503_name not in found}
+    if missing:
+        for line in _run_shell_stdout(
+                ["pacman", "-Q", *missing],
+                stderr=DEVNULL, check=False).splitlines():
+            pkgname, _ = line.split(maxsplit=1)
+            found[missing[pkgname]] = {line: None}
+    for pep503_name in pep503_names:
+        owners[pep503_name] = _INSTALLED_OWNERS[pep503_name] = (
+            found.get(pep503_name, {}))
+    return owners
+
+
+def _find_installed_name_versions(pep503_names, *, ignore_vendored=False):
+    """
+    Map each of *pep503_names* to the name and version of the installed Arch
+    package providing it (or None).
+    """
+    name_versions = {}
+    for pep503_name, owners in _find_installed_owners(pep503_names).items():
+        name_versions[pep503_name] = None
+        if not owners:
+            continue
+        # This will raise if there is an ambiguity.
+        (pkgname, version), = (owner.split() for owner in owners)
         if pkgname.endswith("-git"):
             expected_conflict = pkgname[:-len("-git")]
-            if _run_shell(
-                    f"pacman -Qi {pkgname} 2>/dev/null | "
-                    rf"grep -q 'Conflicts With *:.*\b{expected_conflict}\b'",
-                    check=False).returncode == 0:
+            if re.search(
+                    rf"Conflicts With *:.*\b{expected_conflict}\b",
+                    _run_shell_stdout(["pacman", "-Qi", pkgname],
+                                      stderr=DEVNULL, check=False)):
                 pkgname = pkgname[:-len("-git")]
             else:
                 raise PackagingError(
                     f"Found installed package {pkgname} which does NOT "
                     f"conflict with {expected_conflict}; please uninstall it "
                     f"first.")
-        if ignore_vendored and pkgname.startswith("python--"):
-            return
-        else:
-            return pkgname, ArchVersion.parse(version)
-    else:
+        if not (ignore_vendored and pkgname.startswith("python--")):
+            name_versions[pep503_name] = pkgname, ArchVersion.parse(version)
+    return name_versions
+
+
+def _find_installed_name_version(pep503_name, *, ignore_vendored=False):
+    return _find_installed_name_versions(
+        [pep503_name], ignore_vendored=ignore_vendored)[pep503_name]
+
+
+# {(pep503_name, standalone): ["pkgname version", ...]}
+_ARCH_CANDIDATES = {}
+
+
+def _prefetch_arch_name_versions(pep503_names):
+    """
+    Look up the official packages providing each of *pep503_names* with a
+    single pkgfile call per location (instead of one per name), and store the
+    results for `_find_arch_name_version`.
+    """
+    # Both locations' results are published together at the end, so that
+    # concurrent callers never see only half of them.
+    names = {to_wheel_name(name): name for name in pep503_names
+             if (name, False) not in _ARCH_CANDIDATES}
+    if not names:
         return
+    results = {}
+    for standalone in [True, False]:  # vendored into another Python package?
+        pattern = (
+            "^/usr/lib/python{version.major}\\.{version.minor}/{parent}"
+            "({wheel_names})-.*py{version.major}\\.{version.minor}\\.egg-info"
+            .format(parent="site-packages/" if standalone else "",
+                    wheel_names="|".join(names),
+                    version=sys.version_info))
+        found = {name: {} for name in names.values()}
+        for line in _run_shell_stdout(
+                ["pkgfile", "-riv", pattern], check=False).splitlines():
+            # "repo/pkgname version\tpath"
+            owner, _, path = line.partition("\t")
+            match = re.search(pattern, path.strip(), re.IGNORECASE)
+            if match:
+                found[names[match.group(1).lower()]][
+                    owner.strip().split("/", 1)[-1]] = None
+        for name, candidates in found.items():
+            results[name, standalone] = [*candidates]
+    _ARCH_CANDIDATES.update(results)
 
 
 def _find_arch_name_version(pep503_name):
+    _prefetch_arch_name_versions([pep503_name])
     for standalone in [True, False]:  # vendored into another Python package?
-        *candidates, = map(str.strip, _run_shell_stdout(
-            "pkgfile -riv "
-            "'^/usr/lib/python{version.major}\\.{version.minor}/{parent}"
-            "{wheel_name}-.*py{version.major}\\.{version.minor}\\.egg-info' | "
-            "cut -f1 | uniq | cut -d/ -f2".format(
-                parent="site-packages/" if standalone else "",
-                wheel_name=to_wheel_name(pep503_name),
-                version=sys.version_info)
-        ).splitlines())
+        candidates = _ARCH_CANDIDATES[pep503_name, standalone]
         if len(candidates) > 1:
             message = "Multiple candidates for {}: {}.".format(
                 pep503_name, ", ".join(candidates))
@@ -769,6 +1259,64 @@ def _find_arch_name_version(pep503_name):
             return pkgname, arch_version
 
 
+@lru_cache()
+def _probe_license(base_url):
+    """
+    Return the contents of the first of `LICENSE_NAMES` found on the master
+    branch of the repository at *base_url*, or None.
+    """
+    # Probe all candidates concurrently, but keep LICENSE_NAMES' priority.
+    for content in _EXECUTOR.map(
+            partial(_get_url_cached, max_age=24 * 60 * 60, error_ok=True),
+            [f"{base_url}/master/{license_name}"
+             for license_name in LICENSE_NAMES]):
+        if content is not None:
+            return content
+
+
+@lru_cache()
+def _get_github_license(repo_path):
+    """
+    Return the contents of the first of `LICENSE_NAMES` found at the root of
+    the GitHub repository at *repo_path* (``/owner/name``), or None.
+    """
+    # A single listing of the repository root (on the default branch) avoids
+    # probing each candidate name in turn.
+    try:
+        listing = json.loads(_get_url_cached(
+            f"https://api.github.com/repos{repo_path}/contents/",
+            max_age=24 * 60 * 60))
+    except urllib.error.HTTPError as exc:
+        if exc.code == 404:
+            return None
+        # e.g. API rate limit exceeded.
+        return _probe_license(f"https://raw.githubusercontent.com{repo_path}")
+    download_urls = {entry["name"]: entry["download_url"]
+                     for entry in listing if entry["type"] == "file"}
+    for license_name in LICENSE_NAMES:
+        if license_name in download_urls:
+            return _get_url_cached(
+                download_urls[license_name], max_age=24 * 60 * 60)
+
+
+@lru_cache()
+def _find_arch_packaged(pkgname):
+    """
+    Return the sorted names of the Python packages shipped by the official
+    package *pkgname* (several for metapackages).
+    """
+    # The pkgfile database doesn't change during a run, and the same packages
+    # show up repeatedly as (transitive) dependencies.
+    return sorted({*re.findall(
+        # Package name has no dash (per packaging standard) nor slashes (which
+        # can occur when a subpackage is vendored (depending on how it is
+        # done), e.g. `.../foo.egg-info` and `.../foo/bar.egg-info` both
+        # existing).
+        r"(?m)(?<=site-packages/)[^-/]*(?=.*\.egg-info/?$)",
+        _run_shell_stdout(["pkgfile", "-l", pkgname],
+                          stderr=DEVNULL, check=False))})
+
+
 class NonPyPackageRef:
     def __init__(self, pkgname):
         self.pkgname = self.depname = pkgname
@@ -813,14 +1361,7 @@ class PackageRef:
             pkgname, arch_version = installed or arch or default
             depname, _ = arch or installed or default
 
-        arch_packaged = sorted({*_run_shell_stdout(
-            f"pkgfile -l {pkgname} 2>/dev/null | "
-            # Package name has no dash (per packaging standard) nor slashes
-            # (which can occur when a subpackage is vendored (depending on how
-            # it is done), e.g. `.../foo.egg-info` and `.../foo/bar.egg-info`
-            # both existing).
-            r"grep -Po '(?<=site-packages/)[^-/]*(?=.*\.egg-info/?$)'",
-            check=False).splitlines()})
+        self._unsuffixed_pkgname = pkgname  # For arch_packaged.
 
         # Final values.
         vcs = _get_vcs(name)
@@ -835,9 +1376,14 @@ class PackageRef:
         # This logic is implemented in `DependsTuple.__fmt__`.
         self.depname = depname
         self.arch_version = arch_version
-        self.arch_packaged = arch_packaged
         self.exists = arch_version is not None
 
+    @cached_property
+    def arch_packaged(self):
+        # Only needed for the packages actually being built, not for each of
+        # their dependencies, so spare the pkgfile call until then.
+        return _find_arch_packaged(self._unsuffixed_pkgname)
+
 
 class DependsTuple(tuple):  # Keep it hashable.
     @property
@@ -847,14 +1393,18 @@ class DependsTuple(tuple):  # Keep it hashable.
                      if isinstance(ref, PackageRef))
 
     def __format__(self, fmt):
-        # See above re: dependency type.
-        def _unique(seq): return [*dict.fromkeys(seq)]  # Unique, in order.
-        if fmt == "Package":
-            return " ".join(_unique(ref.depname for ref in self))
-        elif fmt == "MetaPackage":
-            return " ".join(_unique(ref.pkgname for ref in self))
-        else:
-            return super().__format__(fmt)  # Raise TypeError.
+        # See above re: dependency type.  The contents are not modified after
+        # construction, so cache the result per format spec.
+        formatted = self.__dict__.setdefault("_formatted", {})
+        if fmt not in formatted:
+            def _unique(seq): return [*dict.fromkeys(seq)]  # Unique, in order.
+            if fmt == "Package":
+                formatted[fmt] = " ".join(_unique(ref.depname for ref in self))
+            elif fmt == "MetaPackage":
+                formatted[fmt] = " ".join(_unique(ref.pkgname for ref in self))
+            else:
+                return super().__format__(fmt)  # Raise TypeError.
+        return formatted[fmt]
 
 
 BuildCacheEntry = namedtuple(
@@ -866,8 +1416,14 @@ class _BasePackage(ABC):
 
     def __init__(self):
         self._files = {}
+        self._md5sums = {}
         # self._pkgbuild = ...
 
+    def _add_file(self, fname, content):
+        # Hash the contents once, as they get added.
+        self._files[fname] = content
+        self._md5sums[fname] = hashlib.md5(content).hexdigest()
+
     @abc.abstractmethod
     def write_deps(self, options):
         pass
@@ -885,11 +1441,23 @@ class _BasePackage(ABC):
             return options.pkgbuild_extras
 
     def write(self, options):
+        # Dependencies are resolved concurrently (see Package.write_deps), but
+        # builds run one at a time, as concurrent makepkg runs (each possibly
+        # compiling with a full MAKEFLAGS) would oversubscribe the machine and
+        # interleave their output.  write_deps only returns once all
+        # dependencies are built (except for mutual dependencies, see
+        # create_package), so builds still happen in dependency order.
+        with _PACMAN_LOCK:
+            self._write(options)
+
+    def _write(self, options):
         cwd = options.base_path / self.pkgname
         cwd.mkdir(parents=True, exist_ok=options.force)
-        (cwd / "PKGBUILD").write_text(self._pkgbuild)
-        (cwd / "PKGBUILD_EXTRAS").write_text(self.get_pkgbuild_extras(options))
-        for fname, content in self._files.items():
+        for fname, content in {
+                "PKGBUILD": self._pkgbuild.encode("utf-8"),
+                "PKGBUILD_EXTRAS":
+                    self.get_pkgbuild_extras(options).encode("utf-8"),
+                **self._files}.items():
             (cwd / fname).write_bytes(content)
         if isinstance(self, Package):
             srctree = _get_url_packed_path(self._get_pip_url())
@@ -910,15 +1478,22 @@ class _BasePackage(ABC):
             # --packagelist may output multiple lines when debug option is set.
             # only take the first line (the main package).
             return Path(_run_shell_stdout(
-                "makepkg --packagelist",
+                ["makepkg", "--packagelist"],
                 cwd=cwd).splitlines()[0])
 
+        def _run_namcap():
+            # The PKGBUILD and the package are checked by a single namcap call;
+            # lines about the former are prefixed by "PKGBUILD (pkgname)".
+            # fullpath may not exist if --makepkg=--nobuild.
+            return _run_shell_stdout(
+                ["namcap", "PKGBUILD",
+                 *([fullpath] if fullpath.exists() else [])],
+                cwd=cwd, check=False).splitlines()
+
         fullpath = _get_fullpath()
+        namcap = _run_namcap()
         # Update PKGBUILD.
         needs_rebuild = False
-        # fullpath may not exist if --makepkg=--nobuild.
-        namcap = (_run_shell_stdout(["namcap", fullpath], cwd=cwd).splitlines()
-                  if fullpath.exists() else [])
         # `pkgver()` may update the PKGBUILD, so reread it.
         pkgbuild_contents = (cwd / "PKGBUILD").read_text()
         # Binary dependencies.
@@ -946,10 +1521,10 @@ class _BasePackage(ABC):
             # have changed).
             fullpath.unlink()
             (cwd / "PKGBUILD").write_text(pkgbuild_contents)
-            _run_shell("makepkg --force --repackage --nodeps", cwd=cwd)
+            _run_shell(["makepkg", "--force", "--repackage", "--nodeps"],
+                       cwd=cwd)
             fullpath = _get_fullpath()
-        namcap_pkgbuild_report = _run_shell_stdout(
-            "namcap PKGBUILD", cwd=cwd, check=False)
+            namcap = _run_namcap()  # Otherwise, the first report still holds.
         # Suppressed namcap warnings (may be better to do this via a namcap
         # option?):
         # - Python dependencies always get misanalyzed; filter them away.
@@ -958,22 +1533,20 @@ class _BasePackage(ABC):
         # - Extension modules unconditionally link to `libpthread` (see
         #   output of `python-config --libs`); filter that away.
         # - Extension modules appear to never be PIE?
-        namcap_package_report = (
-            _run_shell_stdout(
-                f"namcap {shlex.quote(str(fullpath))} | "
-                f"grep -v \"^{self.pkgname} W: "
-                    r"\(Dependency included and not needed"
-                    r"\|Dependency .* included but already satisfied$"
-                    r"\|Unused shared library '/usr/lib/libpthread\.so\.0' by"
-                    r"\|ELF file .* lacks PIE\.$\)"
-                "\"", cwd=cwd, check=False)
-            if fullpath.exists() else "")
-        namcap_report = [
-            line for report in [namcap_pkgbuild_report, namcap_package_report]
-            for line in report.split("\n") if line]
+        suppressed_re = re.compile(
+            f"^{re.escape(self.pkgname)} W: "
+            r"(Dependency included and not needed"
+            r"|Dependency .* included but already satisfied$"
+            r"|Unused shared library '/usr/lib/libpthread\.so\.0' by"
+            r"|ELF file .* lacks PIE\.$)")
+        namcap_report = [line for line in namcap
+                         if line and not suppressed_re.search(line)]
+        namcap_package_report = "\n".join(
+            line for line in namcap_report if not line.startswith("PKGBUILD "))
         if re.search(f"^{self.pkgname} E: ", namcap_package_report):
             raise PackagingError("namcap found a problem with the package.")
-        _run_shell("makepkg --printsrcinfo >.SRCINFO", cwd=cwd)
+        with Path(cwd, ".SRCINFO").open("w") as file:
+            _run_shell(["makepkg", "--printsrcinfo"], cwd=cwd, stdout=file)
         type(self).build_cache.append(BuildCacheEntry(
             self.pkgname, fullpath, options.is_dep, namcap_report))
         # FIXME Suppress message about redundancy of 'python' dependency.
@@ -986,8 +1559,6 @@ class Package(_BasePackage):
         self._ref = ref
         self._pkgrel = options.pkgrel
 
-        stream = StringIO()
-
         LOGGER.info("Packaging %s %s.",
                     self.pkgname, ref.info["info"]["version"])
         self._urls = self._filter_and_sort_urls(
@@ -998,26 +1569,70 @@ class Package(_BasePackage):
 
         self._find_makedepends(options)
         for dep in self._makedepends:
-            if _run_shell(f"pacman -Q {dep.pkgname} >/dev/null 2>&1",
+            if _run_shell(["pacman", "-Q", dep.pkgname],
+                          stdout=DEVNULL, stderr=DEVNULL,
                           check=False).returncode:
                 # Only log this as needed, to not spam messages about pip.
-                _run_shell(f"sudo pacman -S --asdeps {dep.pkgname}",
-                           verbose=True)
+                with _PACMAN_LOCK:
+                    _run_shell(
+                        ["sudo", "pacman", "-S", "--needed", "--asdeps",
+                         dep.pkgname],
+                        verbose=True)
+                    _INSTALLED_OWNERS.clear()
         self._extract_setup_requires()
 
-        metadata = _get_metadata(
-            f"{ref.orig_name}{gen_ver_cmp_operator(self.pkgver)}"
-            if urllib.parse.urlparse(ref.orig_name).scheme == ""
-            else ref.orig_name,
-            self._makedepends.pep503_names)
+        requires = None
+        requires_dist = ref.info["info"].get("requires_dist")
+        if (self._get_first_package_type() == "bdist_wheel"
+                or (self._get_first_package_type() == "sdist"
+                    and urllib.parse.urlparse(ref.orig_name).scheme == "")):
+            # Read the metadata of the artifact that write() packages, so that
+            # it only gets downloaded once (and through pip's cache).  The
+            # sdist's is only used if static (otherwise, this returns None).
+            packed_path = _get_url_packed_path(self._get_pip_url())
+            requires = (_get_wheel_requires(packed_path)
+                        if packed_path.suffix == ".whl"
+                        else _get_sdist_requires(packed_path))
+        wheels = [url for url in ref.info["urls"]
+                  if url["packagetype"] == "bdist_wheel"]
+        if (requires is None and requires_dist is not None and wheels
+                and all(url["url"].endswith(
+                            ("-py3-none-any.whl", "-py2.py3-none-any.whl"))
+                        for url in wheels)):
+            # PyPI's requires_dist comes from the first uploaded file, which
+            # may be a platform-specific wheel with its own requirements; only
+            # trust it if all wheels are pure (and thus share their static
+            # metadata).  This skips installing the sdist in a venv.
+            try:
+                requires = _evaluate_requirements(tuple(requires_dist))
+            except CalledProcessError:
+                LOGGER.warning(
+                    "Failed to evaluate requires_dist of %s; falling back "
+                    "to building its metadata.", ref.orig_name)
+        if requires is None:
+            if urllib.parse.urlparse(ref.orig_name).scheme == "":
+                # pip resolves the requirement to the same file as write()
+                # packages, which thus identifies the release's metadata.
+                requires = _get_metadata(
+                    f"{ref.orig_name}{gen_ver_cmp_operator(self.pkgver)}",
+                    self._makedepends.pep503_names,
+                    _get_url_packed_path(self._get_pip_url()).name)["requires"]
+            else:
+                requires = _get_metadata(
+                    ref.orig_name, self._makedepends.pep503_names)["requires"]
+        if options.build_deps:
+            pep503_requires = [*map(pep503_normalize_name, requires)]
+            _find_installed_owners(pep503_requires)
+            _prefetch_arch_name_versions(pep503_requires)
         self._depends = DependsTuple(
-            PackageRef(req, pre=options.pre)
+            # Resolve the dependencies concurrently, as this is dominated by
+            # PyPI queries and pkgfile/pacman calls.
+            _EXECUTOR.map(partial(PackageRef, pre=options.pre), requires)
             if options.build_deps else
             # FIXME Could use something slightly better, i.e. still check local
             # packages...
-            NonPyPackageRef("python-{}".format(pep503_normalize_name(req)))
-            for req in metadata["requires"])
-        self._licenses = self._find_license()
+            (NonPyPackageRef("python-{}".format(pep503_normalize_name(req)))
+             for req in requires))
 
         arches = []
         src_template = None
@@ -1027,6 +1642,7 @@ class Package(_BasePackage):
                 if url["packagetype"] != "bdist_wheel":
                     continue
                 wheel_info = WheelInfo.parse(url["url"])
+                platforms = wheel_info.get_arch_platforms()
                 if wheel_info.platform == "any":
                     # If there is both an any wheel and one or more
                     # arch-specific wheels, do not mix them up.
@@ -1037,36 +1653,47 @@ class Package(_BasePackage):
                 else:
                     if src_template == WHEEL_ANY_SOURCE:
                         continue
-                    arches.extend(wheel_info.get_arch_platforms())
+                    arches.extend(platforms)
                     src_template = WHEEL_ARCH_SOURCE
+                name = Path(urllib.parse.urlparse(url["url"]).path).name
                 sources.extend(
-                    src_template.format(
-                        arch=arch,
-                        url=url,
-                        name=Path(urllib.parse.urlparse(url["url"]).path).name)
-                    for arch in wheel_info.get_arch_platforms())
+                    src_template.format(arch=arch, url=url, name=name)
+                    for arch in platforms)
         else:
             arches.append("any")
             sources.append(SDIST_SOURCE.format(url=self._urls[0]))
         self._arch = sorted({*arches})
-        stream.write(
-            PKGBUILD_HEADER.format(pkg=self, config=get_makepkg_conf()))
-        stream.write("".join(sources))
-        stream.write(MORE_SOURCES.format(
-            names=" ".join(shlex.quote(name)
-                           for name in self._files),
-            md5s=" ".join(hashlib.md5(content).hexdigest()
-                          for content in self._files.values())))
-        stream.write(PKGBUILD_CONTENTS)
-
-        self._pkgbuild = stream.getvalue()
+        self._sources = sources
+
+    # The license lookup (which may hit the network) and the PKGBUILD assembly
+    # are deferred until the package actually gets written, i.e. after its
+    # dependencies have been discovered (and possibly built).
+    @cached_property
+    def _licenses(self):
+        return self._find_license()
+
+    @cached_property
+    def _pkgbuild(self):
+        self._licenses  # Populate self._files first.
+        return "".join([
+            PKGBUILD_HEADER.format(pkg=self, packager=get_packager()),
+            *self._sources,
+            MORE_SOURCES.format(
+                names=" ".join(shlex.quote(name) for name in self._files),
+                md5s=" ".join(self._md5sums.values())),
+            PKGBUILD_CONTENTS,
+        ])
 
     def _filter_and_sort_urls(self, unfiltered_urls, pkgtypes):
+        # Earlier entries are preferred; first occurrence wins.
+        ranks = {}
+        for rank, pkgtype in enumerate(pkgtypes):
+            ranks.setdefault(pkgtype, rank)
         urls = []
         for url in unfiltered_urls:
             if url["packagetype"] == "bdist_wheel":
                 wh_info = WheelInfo.parse(url["url"])
-                if not wh_info.pythons.intersection(PY_TAGS):
+                if wh_info.pythons.isdisjoint(PY_TAGS):
                     continue
                 if wh_info.platform == "any":
                     pkgtype = "anywheel"
@@ -1074,9 +1701,8 @@ class Package(_BasePackage):
                     pkgtype = "manylinuxwheel"
                 else:
                     continue
-                try:
-                    order = pkgtypes.index(pkgtype)
-                except ValueError:
+                order = ranks.get(pkgtype)
+                if order is None:
                     continue
                 else:
                     # - https://packaging.python.org/en/latest/specifications/binary-distribution-format/#escaping-and-unicode
@@ -1098,8 +1724,8 @@ class Package(_BasePackage):
                     else:
                         urls.append((url, order))
             elif url["packagetype"] == "sdist":
-                with suppress(ValueError):
-                    urls.append((url, pkgtypes.index("sdist")))
+                if "sdist" in ranks:
+                    urls.append((url, ranks["sdist"]))
             else:  # Skip other dists.
                 continue
         return [url for url, key in sorted(urls, key=lambda kv: kv[1])]
@@ -1131,41 +1757,45 @@ class Package(_BasePackage):
             *(_guess_url_makedepends(self._get_sdist_url(),
                                      options.guess_makedepends)
               if self._get_first_package_type() != "bdist_wheel" else ())))
+        pkgbuild_extras = self.get_pkgbuild_extras(options)
+        if not pkgbuild_extras.strip():
+            return  # No need to run makepkg to find that there's nothing.
         with TemporaryDirectory() as tmpdir:
             Path(tmpdir, "PKGBUILD").write_text(
                 # makepkg always requires that these three variables are set.
                 f"pkgname={self.pkgname}\n"
                 f"pkgver={self.pkgver}\n"
                 f"pkgrel={self.pkgrel}\n"
-                + self.get_pkgbuild_extras(options))
-            extra_makedepends = _run_shell_stdout(
-                r"makepkg --printsrcinfo | "
-                r"grep -Po '(?<=^\tmakedepends = ).*'",
-                cwd=tmpdir, check=False)
+                + pkgbuild_extras)
+            extra_makedepends = re.findall(
+                r"(?m)(?<=^\tmakedepends = ).*",
+                _run_shell_stdout(["makepkg", "--printsrcinfo"],
+                                  cwd=tmpdir, check=False))
             if extra_makedepends:
                 self._makedepends = DependsTuple(
                     [*self._makedepends,
                      # Use NonPyPackageRef even when the extra makedepends is
                      # actually a Python package, because we need access to it
                      # (as a system package) from within the build venv.
-                     *map(NonPyPackageRef, extra_makedepends.split("\n"))])
+                     *map(NonPyPackageRef, extra_makedepends)])
 
     def _extract_setup_requires(self):
-        makedepends = []
-        for pkg in self._makedepends:
+        def _to_python_ref(pkg):
             if isinstance(pkg, PackageRef):
-                makedepends.append(pkg)
+                return pkg
             elif isinstance(pkg, NonPyPackageRef):
-                pep503_name = _run_shell_stdout(
-                    f"pacman -Qql {pkg.pkgname} | "
-                    f"grep -Po '(?<=^{site.getsitepackages()[0]}/)"
-                    r"[^-]*(?=-.*\.(dist|egg)-info/$)'",
-                    check=False)
-                makedepends.append(
-                    PackageRef(pep503_name) if pep503_name else pkg)
+                pep503_name = "\n".join(re.findall(
+                    f"(?m)(?<=^{re.escape(site.getsitepackages()[0])}/)"
+                    r"[^-]*(?=-.*\.(?:dist|egg)-info/$)",
+                    _run_shell_stdout(["pacman", "-Qql", pkg.pkgname],
+                                      check=False)))
+                return PackageRef(pep503_name) if pep503_name else pkg
             else:
                 raise TypeError("Unexpected makedepends entry")
-        self._makedepends = DependsTuple(makedepends)
+
+        # Each entry may need a pacman query and a PyPI lookup.
+        self._makedepends = DependsTuple(
+            _EXECUTOR.map(_to_python_ref, self._makedepends))
 
     def _find_license(self):
         # FIXME Support license-in-wheel.
@@ -1177,13 +1807,9 @@ class Package(_BasePackage):
                and classifier != "License :: OSI Approved"]  # What's that?...
         if license_classes:
             for license_class in license_classes:
-                *_, license_class = license_class.split(" :: ")
-                try:
-                    licenses.append(
-                        {**TROVE_COMMON_LICENSES,
-                         **TROVE_SPECIAL_LICENSES}[license_class])
-                except KeyError:
-                    licenses.append(f"LicenseRef-{license_class}")
+                license_class = license_class.rpartition(" :: ")[2]
+                licenses.append(TROVE_LICENSES.get(
+                    license_class, f"LicenseRef-{license_class}"))
         # pypa/warehouse#3473: "UNKNOWN" -> "", but not for old pkgs.
         elif info["license"] not in [None, "", "UNKNOWN"]:
             licenses.append("LicenseRef-{}".format(info["license"]))
@@ -1191,63 +1817,48 @@ class Package(_BasePackage):
             LOGGER.warning("No license information available.")
             licenses.append("LicenseRef-unknown")
 
+        if {*licenses} <= {*TROVE_COMMON_LICENSES.values()}:
+            # Shipped by the `licenses` package; no need to look for a file.
+            return licenses
+
         _license_found = False
-        if any(license not in TROVE_COMMON_LICENSES for license in licenses):
-            for url in [info["download_url"], info["home_page"]]:
-                parsed = urllib.parse.urlparse(url or "")  # Could be None.
-                if len(Path(parsed.path).parts) != 3:  # ["/", user, name]
-                    continue
-                # Strip final slash for later manipulations.
-                parsed = parsed._replace(path=re.sub("/$", "", parsed.path))
-                # Could instead lookup
-                #   https://api.github.com/repos/:owner/:repo/contents
-                # or see opengh/github-ls.
-                if parsed.netloc in ["github.com", "www.github.com"]:
-                    parsed = parsed._replace(
-                        netloc="raw.githubusercontent.com")
-                elif parsed.netloc in ["bitbucket.org", "www.bitbucket.org"]:
-                    parsed = parsed._replace(
-                        path=parsed.path + "/raw")
-                else:
-                    continue
-                for license_name in LICENSE_NAMES:
-                    try:
-                        r = urllib.request.urlopen(
-                            urllib.parse.urlunparse(
-                                parsed._replace(path=parsed.path + "/master/"
-                                                     + license_name)))
-                    except urllib.error.HTTPError:
-                        pass
-                    else:
-                        self._files.update(LICENSE=r.read())
-                        _license_found = True
-                        break
-                if _license_found:
-                    break
+        for url in [info["download_url"], info["home_page"]]:
+            parsed = urllib.parse.urlparse(url or "")  # Could be None.
+            if len(Path(parsed.path).parts) != 3:  # ["/", user, name]
+                continue
+            # Strip final slash for later manipulations.
+            parsed = parsed._replace(path=re.sub("/$", "", parsed.path))
+            if parsed.netloc in ["github.com", "www.github.com"]:
+                content = _get_github_license(parsed.path)
+            elif parsed.netloc in ["bitbucket.org", "www.bitbucket.org"]:
+                content = _probe_license(
+                    f"https://bitbucket.org{parsed.path}/raw")
             else:
-                try:
-                    sdist_unpackacked_path = _get_url_unpacked_path_or_null(
-                        self._get_sdist_url())
-                    # Should really fail with CalledProcessError (e.g. if
-                    # wheel-only) but that can actually be transformed into a
-                    # PackagingError; see _get_url_impl for explanation...
-                except PackagingError:
-                    pass
-                else:
-                    for path in map(sdist_unpackacked_path.joinpath,
-                                    LICENSE_NAMES):
-                        if path.is_file():
-                            self._files.update(LICENSE=path.read_bytes())
-                            _license_found = True
-                            break
-            if not _license_found:
-                self._files.update(
-                    # These entries are mostly from a fixed, ASCII-only list,
-                    # but can also be read from info["license"] which doesn't
-                    # have to be ASCII.
-                    LICENSE=("LICENSE: " + ", ".join(licenses) + "\n")
-                            .encode("utf-8"))
-                LOGGER.warning("Could not retrieve license file.")
+                continue
+            if content is not None:
+                self._add_file("LICENSE", content)
+                _license_found = True
+                break
+        else:
+            try:
+                license = _scan_url_tree(self._get_sdist_url()).license
+                # Should really fail with CalledProcessError (e.g. if
+                # wheel-only) but that can actually be transformed into a
+                # PackagingError; see _get_url_impl for explanation...
+            except PackagingError:
+                pass
+            else:
+                if license is not None:
+                    self._add_file("LICENSE", license)
+                    _license_found = True
+        if not _license_found:
+            self._add_file(
+                "LICENSE",
+                # These entries are mostly from a fixed, ASCII-only list,
+                # but can also be read from info["license"] which doesn't
+                # have to be ASCII.
+                ("LICENSE: " + ", ".join(licenses) + "\n").encode("utf-8"))
+            LOGGER.warning("Could not retrieve license file.")
 
         return licenses
 
@@ -1257,22 +1868,24 @@ class Package(_BasePackage):
         lambda self:
         self._ref.arch_version.epoch if self._ref.arch_version else "")
     # NOTE: some metadata can be corrupted due to pypa/setuptools#1390 :/
-    pkgver = property(
+    # The quoted values are computed once, as the PKGBUILD may get formatted
+    # several times.
+    pkgver = cached_property(
         lambda self: shlex.quote(self._ref.info["info"]["version"]))
     pkgrel = property(
         lambda self: self._pkgrel)
-    pkgdesc = property(
+    pkgdesc = cached_property(
         lambda self: shlex.quote(self._ref.info["info"]["summary"]))
     arch = property(
         lambda self: " ".join(self._arch))
-    url = property(
+    url = cached_property(
         lambda self: shlex.quote(
             next(url for url in [self._ref.info["info"]["home_page"],
                                  self._ref.info["info"]["download_url"],
                                  self._ref.info["info"]["package_url"]]
                  # pypa/warehouse#3473: "UNKNOWN" -> "", but not for old pkgs.
                  if url not in [None, "", "UNKNOWN"])))
-    license = property(
+    license = cached_property(
         lambda self: " ".join(map(shlex.quote, self._licenses)))
     depends = property(
         lambda self: self._depends)
@@ -1296,10 +1909,22 @@ class Package(_BasePackage):
             return f"{name}={self.pkgver}"
 
     def write_deps(self, options):
-        for ref in self._depends:
-            if not ref.exists:
-                # Dependency not found, build it too.
-                create_package(ref.pep503_name, options._replace(is_dep=True))
+        missing = [ref for ref in self._depends if not ref.exists]
+        if not missing:
+            return
+        # Dependencies not found, build them too.  Builds use --nodeps and
+        # installation only happens at the very end, so independent subtrees
+        # can be resolved concurrently (the builds themselves are serialized,
+        # see write).  Each level gets its own (bounded) pool, so that parents
+        # never wait for a slot taken by their own children.
+        parent = getattr(_CREATE_PACKAGE_CURRENT, "key", None)
+        with ThreadPoolExecutor(max_workers=min(len(missing), 8)) as executor:
+            for _ in executor.map(
+                    lambda ref: create_package(
+                        ref.pep503_name, options._replace(is_dep=True),
+                        _parent=parent),
+                    missing):
+                pass  # Propagate exceptions.
 
 
 class MetaPackage(_BasePackage):
@@ -1308,9 +1933,9 @@ class MetaPackage(_BasePackage):
         self._ref = ref
         self._arch_version = self._ref.arch_version._replace(
             pkgrel=self._ref.arch_version.pkgrel + ".99")
-        self._subpkgrefs = DependsTuple(
-            PackageRef(name, subpkg_of=ref, pre=options.pre)
-            for name in ref.arch_packaged)
+        self._subpkgrefs = DependsTuple(_EXECUTOR.map(
+            partial(PackageRef, subpkg_of=ref, pre=options.pre),
+            ref.arch_packaged))
         self._subpkgs = [Package(ref, options) for ref in self._subpkgrefs]
         for pkg in self._subpkgs:
             pkg._pkgbuild = re.sub(
@@ -1320,7 +1945,7 @@ class MetaPackage(_BasePackage):
                 pkg._pkgbuild,
                 1)
         self._pkgbuild = (
-            PKGBUILD_HEADER.format(pkg=self, config=get_makepkg_conf())
+            PKGBUILD_HEADER.format(pkg=self, packager=get_packager())
             + METAPKGBUILD_CONTENTS)
 
     pkgname = property(
@@ -1364,17 +1989,61 @@ class MetaPackage(_BasePackage):
             base_path=self._get_target_path(options.base_path)))
 
 
-_CREATE_PACKAGE_CACHE = set()
+_CREATE_PACKAGE_FUTURES = {}  # {(name, options): Future}
+# {(name, options): {(name, options), ...}}: the creations that each creation
+# is waiting for (through write_deps).
+_CREATE_PACKAGE_WAITS = {}
+_CREATE_PACKAGE_LOCK = threading.Lock()
+# The creation whose dependencies are being written by this thread.
+_CREATE_PACKAGE_CURRENT = threading.local()
 
 
-def create_package(name, options):
+def _create_package_waits_for(key, other):
+    # Whether *key* is (transitively) waiting for *other*.
+    return key == other or any(
+        _create_package_waits_for(dep, other)
+        for dep in _CREATE_PACKAGE_WAITS.get(key, ()))
+
+
+def create_package(name, options, *, _parent=None):
     # This cannot use lru_cache because, in the case of mutually dependent
     # packages, we want to prevent infinite recursion through write_deps (which
     # is called *before* create_package returns, whereas lru_cache would only
-    # populate the cache *after* it returns).
-    if (name, options) in _CREATE_PACKAGE_CACHE:
-        return
-    _CREATE_PACKAGE_CACHE.add((name, options))
+    # populate the cache *after* it returns).  Dependencies concurrently being
+    # created by another thread are waited for, unless that would deadlock,
+    # i.e. for mutual dependencies.
+    key = name, options
+    with _CREATE_PACKAGE_LOCK:
+        future = _CREATE_PACKAGE_FUTURES.get(key)
+        if future is None:
+            future = _CREATE_PACKAGE_FUTURES[key] = Future()
+            owner = True
+        elif (_parent is not None and not future.done()
+              and _create_package_waits_for(key, _parent)):
+            return
+        else:
+            owner = False
+        if _parent is not None:
+            _CREATE_PACKAGE_WAITS.setdefault(_parent, set()).add(key)
+    try:
+        if not owner:
+            future.result()
+            return
+        try:
+            _create_package(key)
+        except BaseException as exc:
+            future.set_exception(exc)
+            raise
+        else:
+            future.set_result(None)
+    finally:
+        if _parent is not None:
+            with _CREATE_PACKAGE_LOCK:
+                _CREATE_PACKAGE_WAITS[_parent].discard(key)
+
+
+def _create_package(key):
+    name, options = key
     ref = PackageRef(
         name, pre=options.pre, guess_makedepends=options.guess_makedepends)
     if options.pkgname:
@@ -1382,7 +2051,12 @@ def create_package(name, options):
     cls = Package if len(ref.arch_packaged) <= 1 else MetaPackage
     pkg = cls(ref, options)
     if options.build_deps:
-        pkg.write_deps(options)
+        prev_key = getattr(_CREATE_PACKAGE_CURRENT, "key", None)
+        _CREATE_PACKAGE_CURRENT.key = key
+        try:
+            pkg.write_deps(options)
+        finally:
+            _CREATE_PACKAGE_CURRENT.key = prev_key
     pkg.write(options)
 
 
@@ -1391,10 +2065,12 @@ def find_outdated():
         "-mpip", "list", "--outdated", "--format=json", "--path",
         site.getsitepackages()[0],
     ], stdout=PIPE).stdout)
+    name_versions = _find_installed_name_versions(
+        pep503_normalize_name(row["name"]) for row in outdated)
     owners = {}
     for row in outdated:
-        pkgname, arch_version = _find_installed_name_version(
-            pep503_normalize_name(row["name"]))
+        pkgname, arch_version = name_versions[
+            pep503_normalize_name(row["name"])]
         # Check that pypi's version is indeed newer.  Some packages mis-report
         # their version to pip (e.g., slicerator 0.9.7's Github release).
         if arch_version.pkgver == row["latest_version"]:
@@ -1456,6 +2132,9 @@ def main():
     parser.add_argument(
         "-v", "--verbose", action="store_true", default=False,
         help="Log at DEBUG level.")
+    parser.add_argument(
+        "--no-cache", action="store_true", default=False,
+        help="Revalidate cached HTTP responses and rebuild cached metadata.")
     parser.add_argument(
         "-o", "--outdated", action="store_true", default=False,
         help="Find outdated packages.")
@@ -1519,6 +2198,8 @@ def main():
         default="",
         help="Additional arguments to pass to `pacman -U`.")
     args = parser.parse_args()
+    global _CACHE_ALWAYS_REVALIDATE
+    _CACHE_ALWAYS_REVALIDATE = vars(args).pop("no_cache")
     log_level = logging.DEBUG if vars(args).pop("verbose") else logging.INFO
     LOGGER.setLevel(log_level)
     logging.basicConfig(level=log_level)
@@ -1541,7 +2222,7 @@ def main():
         if shutil.which(cmd) is None:
             parser.error(f"Missing dependency: {cmd}")
     try:
-        _run_shell("pkgfile pkgfile >/dev/null")
+        _run_shell(["pkgfile", "pkgfile"], stdout=DEVNULL)
     except CalledProcessError:
         # "error: No repo files found. Please run `pkgfile --update'."
         sys.exit(1)
@@ -1596,8 +2277,7 @@ def main():
                 if cache_entry.is_dep]
         if deps:
             cmd += "; pacman -D --asdeps {}".format(" ".join(deps))
-        cmd = "sudo sh -c {}".format(shlex.quote(cmd))
-        _run_shell(cmd, check=False, verbose=True)
+        _run_shell(["sudo", "sh", "-c", cmd], check=False, verbose=True)
 
 
 if __name__ == "__main__":
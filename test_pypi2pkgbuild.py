@@ -1,10 +1,19 @@
+from concurrent.futures import ThreadPoolExecutor
 import functools
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
 import os
 from pathlib import Path
 import subprocess
 import sys
+import tarfile
 from tempfile import TemporaryDirectory
-from unittest import TestCase
+import threading
+from unittest import TestCase, mock
+import urllib.error
+import zipfile
+
+import pypi2pkgbuild
 
 
 _local_path = Path(__file__).parent
@@ -39,3 +48,283 @@ class TestPyPI2PKGBUILD(TestCase):
                 _run([sys.executable, _local_path / "pypi2pkgbuild.py",
                       "-v", "-I", f"-m={makepkg_opts}", "-b", tmp_path / "w",
                       f"file://{wheel_path}"])
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    responses_ = []  # (status, headers, body), consumed in order.
+    requests_ = []  # Request headers, as received.
+
+    def do_GET(self):
+        self.requests_.append(dict(self.headers))
+        status, headers, body = self.responses_.pop(0)
+        self.send_response(status)
+        for k, v in {**headers, "Content-Length": len(body)}.items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestURLCache(TestCase):
+
+    def setUp(self):
+        server = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        self.addCleanup(self._close_connections)
+        self.url = f"http://127.0.0.1:{server.server_port}/x"
+        _Handler.responses_ = []
+        _Handler.requests_ = []
+        tmp_dir = TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        for patcher in [
+                mock.patch.object(
+                    pypi2pkgbuild, "CACHE_DIR", Path(tmp_dir.name)),
+                mock.patch.object(pypi2pkgbuild, "_HTTP_RETRY_DELAYS", [])]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def _close_connections(self):
+        conns = vars(pypi2pkgbuild._HTTP_CONNECTIONS)
+        while conns:
+            conns.popitem()[1].close()
+
+    def test_fresh_hit(self):
+        _Handler.responses_ = [(200, {}, b"foo")]
+        for _ in range(2):
+            self.assertEqual(
+                pypi2pkgbuild._get_url_cached(self.url, max_age=60), b"foo")
+        self.assertEqual(len(_Handler.requests_), 1)
+
+    def test_revalidation(self):
+        _Handler.responses_ = [(200, {"ETag": '"e"'}, b"foo"),
+                               (304, {}, b"")]
+        for _ in range(2):
+            self.assertEqual(
+                pypi2pkgbuild._get_url_cached(self.url, max_age=0), b"foo")
+        self.assertEqual(_Handler.requests_[1].get("If-None-Match"), '"e"')
+
+    def test_not_found_persisted(self):
+        _Handler.responses_ = [(404, {}, b"")]
+        for _ in range(2):
+            self.assertIsNone(pypi2pkgbuild._get_url_cached(
+                self.url, max_age=60, error_ok=True))
+        self.assertEqual(len(_Handler.requests_), 1)
+
+    def test_transient_error_not_persisted(self):
+        for status in [403, 429, 503]:
+            with self.subTest(status=status):
+                _Handler.responses_ = [(status, {}, b""), (200, {}, b"foo")]
+                with self.assertRaises(urllib.error.HTTPError):
+                    pypi2pkgbuild._get_url_cached(self.url, max_age=60)
+                self.assertEqual(
+                    pypi2pkgbuild._get_url_cached(self.url, max_age=60),
+                    b"foo")
+                # Reset for the next status.
+                for path in pypi2pkgbuild.CACHE_DIR.iterdir():
+                    path.unlink()
+
+    def test_transient_error_serves_stale(self):
+        _Handler.responses_ = [(200, {}, b"foo"), (503, {}, b"")]
+        for _ in range(2):
+            self.assertEqual(
+                pypi2pkgbuild._get_url_cached(self.url, max_age=0), b"foo")
+        self.assertEqual(len(_Handler.requests_), 2)
+
+    def test_redirect_loop(self):
+        _Handler.responses_ = [(302, {"Location": "/x"}, b"")] * 11
+        with self.assertRaises(urllib.error.HTTPError) as cm:
+            pypi2pkgbuild._urlopen(self.url)
+        self.assertEqual(cm.exception.code, 302)
+        self.assertEqual(len(_Handler.requests_), 11)
+
+    def test_no_proxy(self):
+        _Handler.responses_ = [(200, {}, b"foo")]
+        with mock.patch.dict(os.environ, {"http_proxy": "http://0.0.0.0:1",
+                                          "no_proxy": "127.0.0.1"}):
+            self.assertEqual(pypi2pkgbuild._urlopen(self.url).read(), b"foo")
+        # The connection was made directly, and kept alive.
+        self.assertTrue(vars(pypi2pkgbuild._HTTP_CONNECTIONS))
+
+
+_REQUIRES_DIST = """\
+Requires-Dist: foo
+Requires-Dist: bar; python_version < "3"
+Requires-Dist: baz; extra == "test"
+Requires-Dist: quux>=1; python_version >= "3"
+"""
+
+
+class TestStaticRequires(TestCase):
+    # Marker evaluation goes through the clean venv (which gets `packaging`
+    # from PyPI).
+
+    def setUp(self):
+        tmp_dir = TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.tmp_path = Path(tmp_dir.name)
+
+    def _make_sdist(self, name, pkg_info):
+        # Use distinct names, as results are cached per path.
+        path = self.tmp_path / name / "pkg-1.0.tar.gz"
+        path.parent.mkdir()
+        with tarfile.open(path, "w:gz") as tf:
+            data = pkg_info.encode()
+            info = tarfile.TarInfo("pkg-1.0/PKG-INFO")
+            info.size = len(data)
+            tf.addfile(info, BytesIO(data))
+        return path
+
+    def test_wheel(self):
+        path = self.tmp_path / "pkg-1.0-py3-none-any.whl"
+        with zipfile.ZipFile(path, "w") as zf:
+            zf.writestr("pkg/__init__.py", "")
+            zf.writestr("pkg-1.0.dist-info/METADATA",
+                        "Metadata-Version: 2.1\nName: pkg\nVersion: 1.0\n"
+                        + _REQUIRES_DIST)
+        self.assertEqual(pypi2pkgbuild._get_wheel_requires(path),
+                         ["foo", "quux"])
+
+    def test_invalid_wheel(self):
+        for name, files in [
+                ("no-metadata", {}),
+                ("invalid-marker",
+                 {"pkg-1.0.dist-info/METADATA":
+                  "Metadata-Version: 2.1\nName: pkg\nVersion: 1.0\n"
+                  "Requires-Dist: foo; python_version <<< '3'\n"})]:
+            with self.subTest(name=name):
+                path = self.tmp_path / name / "pkg-1.0-py3-none-any.whl"
+                path.parent.mkdir()
+                with zipfile.ZipFile(path, "w") as zf:
+                    zf.writestr("pkg/__init__.py", "")
+                    for fname, content in files.items():
+                        zf.writestr(fname, content)
+                self.assertIsNone(pypi2pkgbuild._get_wheel_requires(path))
+
+    def test_static_sdist(self):
+        path = self._make_sdist(
+            "static", "Metadata-Version: 2.2\nName: pkg\nVersion: 1.0\n"
+            + _REQUIRES_DIST)
+        self.assertEqual(pypi2pkgbuild._get_sdist_requires(path),
+                         ["foo", "quux"])
+
+    def test_dynamic_sdist(self):
+        for name, header in [
+                ("legacy", "Metadata-Version: 2.1\n"),
+                ("dynamic",
+                 "Metadata-Version: 2.2\nDynamic: Requires-Dist\n")]:
+            with self.subTest(name=name):
+                path = self._make_sdist(
+                    name,
+                    header + "Name: pkg\nVersion: 1.0\n" + _REQUIRES_DIST)
+                self.assertIsNone(pypi2pkgbuild._get_sdist_requires(path))
+
+
+class TestArchLookup(TestCase):
+
+    def test_prefetch_arch_name_versions(self):
+        site = "/usr/lib/python{0.major}.{0.minor}/site-packages".format(
+            sys.version_info)
+        egg_info = "py{0.major}.{0.minor}.egg-info".format(sys.version_info)
+        standalone_output = "\n".join([
+            f"extra/python-numpy 1.26.4-1\t{site}/numpy-1.26.4-{egg_info}",
+            f"extra/python-numpy 1.26.4-1\t"
+            f"{site}/numpy-1.26.4-{egg_info}/PKG-INFO",
+            f"extra/python-typing_extensions 4.9.0-1\t"
+            f"{site}/typing_extensions-4.9.0-{egg_info}",
+        ])
+
+        def run(args, **kwargs):
+            self.assertEqual(args[:2], ["pkgfile", "-riv"])
+            return standalone_output if "site-packages/" in args[2] else ""
+
+        with mock.patch.dict(pypi2pkgbuild._ARCH_CANDIDATES, clear=True), \
+             mock.patch.object(pypi2pkgbuild, "_run_shell_stdout",
+                               side_effect=run) as run_mock:
+            names = ["numpy", "typing-extensions", "missing"]
+            pypi2pkgbuild._prefetch_arch_name_versions(names)
+            self.assertEqual(run_mock.call_count, 2)  # One per location.
+            self.assertEqual(
+                [pypi2pkgbuild._find_arch_name_version(name)
+                 for name in names],
+                [("python-numpy", pypi2pkgbuild.ArchVersion.parse("1.26.4-1")),
+                 ("python-typing_extensions",
+                  pypi2pkgbuild.ArchVersion.parse("4.9.0-1")),
+                 None])
+            self.assertEqual(run_mock.call_count, 2)  # All prefetched.
+
+    def test_find_installed_owners(self):
+        with TemporaryDirectory() as site_packages:
+            for entry in ["numpy-1.26.4.dist-info",
+                          "Foo.Bar-1.0-py3.11.egg-info",
+                          "numpyx-1.0.dist-info"]:
+                Path(site_packages, entry).mkdir()
+
+            def run(args, **kwargs):
+                if args[:2] == ["pacman", "-Qo"]:
+                    self.assertEqual(
+                        sorted(Path(arg).name for arg in args[2:]),
+                        ["Foo.Bar-1.0-py3.11.egg-info",
+                         "numpy-1.26.4.dist-info"])
+                    return "\n".join([
+                        f"{site_packages}/numpy-1.26.4.dist-info/ is owned "
+                        f"by python-numpy 1.26.4-1",
+                        f"{site_packages}/Foo.Bar-1.0-py3.11.egg-info/ is "
+                        f"owned by python-foo-bar 1.0-1",
+                    ])
+                elif args[:2] == ["pacman", "-Q"]:
+                    self.assertEqual(args[2:], ["python-six", "python-nope"])
+                    return "python-six 1.16.0-1"
+                self.fail(f"Unexpected call: {args}")
+
+            with mock.patch.dict(pypi2pkgbuild._INSTALLED_OWNERS,
+                                 clear=True), \
+                 mock.patch.object(pypi2pkgbuild.site, "getsitepackages",
+                                   return_value=[site_packages]), \
+                 mock.patch.object(pypi2pkgbuild, "_run_shell_stdout",
+                                   side_effect=run):
+                self.assertEqual(
+                    pypi2pkgbuild._find_installed_owners(
+                        ["numpy", "foo-bar", "foo", "six", "nope"]),
+                    {"numpy": {"python-numpy 1.26.4-1": None},
+                     "foo-bar": {"python-foo-bar 1.0-1": None},
+                     # The same path matches both names.
+                     "foo": {"python-foo-bar 1.0-1": None},
+                     "six": {"python-six 1.16.0-1": None},
+                     "nope": {}})
+
+
+class TestCreatePackage(TestCase):
+
+    def test_dependency_order(self):
+        # b and d, and a and b, are mutually dependent; both a and c depend on
+        # d, which must be built before either of them.
+        graph = {"a": ["b", "c", "d"], "b": ["d", "a"], "c": ["d"],
+                 "d": ["b"]}
+        built = []
+
+        def create(key):
+            name, options = key
+            with ThreadPoolExecutor(max_workers=8) as executor:
+                for _ in executor.map(
+                        lambda dep: pypi2pkgbuild.create_package(
+                            dep, options, _parent=key),
+                        graph[name]):
+                    pass
+            built.append(name)
+
+        with mock.patch.dict(pypi2pkgbuild._CREATE_PACKAGE_FUTURES,
+                             clear=True), \
+             mock.patch.dict(pypi2pkgbuild._CREATE_PACKAGE_WAITS,
+                             clear=True), \
+             mock.patch.object(pypi2pkgbuild, "_create_package",
+                               side_effect=create):
+            pypi2pkgbuild.create_package("a", None)
+        self.assertEqual(sorted(built), ["a", "b", "c", "d"])
+        self.assertLess(built.index("d"), built.index("c"))
+        self.assertEqual(built[-1], "a")